@@ -1,36 +1,63 @@
+import json
 import logging
-import math
-import functools
+import operator
+from itertools import chain
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 """A coordinate of a station precision of which we must take into account
 is calculated as an average of somewhat 10 elements.
 Taking machine epsilon 1e-15, averaging 10 numbers with close magnitudes
 ensures relative precision of 1e-14."""
-coord_isclose = functools.partial(math.isclose, rel_tol=1e-14)
+COORD_REL_TOL = 1e-14
+
+# Keys to compare stops and routes, extracted in one C-level call.
+# 'name' key of a route is omitted since RouteMaster
+# can get its name from one of its Routes unpredictably.
+_STOP_PROPS = operator.itemgetter('name', 'int_name', 'id', 'osm_id', 'osm_type')
+_ROUTE_PROPS = operator.itemgetter('type', 'ref', 'colour', 'route_id')
+_ROUTE_ID = operator.itemgetter('route_id')
+
+
+def load_json(path):
+    """Reads a json file, with orjson if it is installed"""
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            return orjson.loads(f.read())
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
 
 
 def coords_eq(lon1, lat1, lon2, lat2):
-    return coord_isclose(lon1, lon2) and coord_isclose(lat1, lat2)
+    # Coordinates of equal stops usually match exactly,
+    # so try a plain comparison before the tolerant one
+    if lon1 == lon2 and lat1 == lat2:
+        return True
+    # Same as math.isclose(a, b, rel_tol=COORD_REL_TOL) without a call
+    return (abs(lon1 - lon2) <= COORD_REL_TOL * max(abs(lon1), abs(lon2)) and
+            abs(lat1 - lat2) <= COORD_REL_TOL * max(abs(lat1), abs(lat2)))
 
 
-def osm_id_comparator(el):
-    """This function is used as key for sorting lists of
-       OSM-originated objects
-    """
-    return (el['osm_type'], el['osm_id'])
+# Key for sorting lists of OSM-originated objects
+osm_id_comparator = operator.itemgetter('osm_type', 'osm_id')
 
 
 def itinerary_comparator(itinerary):
     "This function is used as key for sorting itineraries in a route"""
-    return (itinerary['stops'], itinerary['interval'])
+    # Flat tuple of stop uids and times compares faster than
+    # a list of [uid, time] lists and yields the same order
+    return (tuple(chain.from_iterable(itinerary['stops'])),
+            itinerary['interval'])
 
 
 def compare_stops(stop0, stop1):
     """Compares json of two stops in route"""
-    stop_keys = ('name', 'int_name', 'id', 'osm_id', 'osm_type')
-    stop0_props = tuple(stop0[k] for k in stop_keys)
-    stop1_props = tuple(stop1[k] for k in stop_keys)
+    stop0_props = _STOP_PROPS(stop0)
+    stop1_props = _STOP_PROPS(stop1)
 
     if stop0_props != stop1_props:
         logging.debug("Different stops properties: %s, %s",
@@ -44,21 +71,32 @@ def compare_stops(stop0, stop1):
                       stop1_props, stop1['lon'], stop1['lat'])
         return False
 
-    entrances0 = sorted(stop0['entrances'], key=osm_id_comparator)
-    entrances1 = sorted(stop1['entrances'], key=osm_id_comparator)
-    if entrances0 != entrances1:
+    # Lists are sorted only if they differ in their original order
+    if (stop0['entrances'] != stop1['entrances'] and
+            sorted(stop0['entrances'], key=osm_id_comparator) !=
+            sorted(stop1['entrances'], key=osm_id_comparator)):
         logging.debug("Different stop entrances")
         return False
 
-    exits0 = sorted(stop0['exits'], key=osm_id_comparator)
-    exits1 = sorted(stop1['exits'], key=osm_id_comparator)
-    if exits0 != exits1:
+    if (stop0['exits'] != stop1['exits'] and
+            sorted(stop0['exits'], key=osm_id_comparator) !=
+            sorted(stop1['exits'], key=osm_id_comparator)):
         logging.debug("Different stop exits")
         return False
 
     return True
 
 
+def normalize_transfer(transfer):
+    """Returns a transfer as a tuple (stop1_uid, stop2_uid, time)
+       with stop1_uid < stop2_uid
+    """
+    uid1, uid2, time = transfer
+    if uid1 < uid2:
+        return (uid1, uid2, time)
+    return (uid2, uid1, time)
+
+
 def compare_transfers(transfers0, transfers1):
     """Compares two arrays of transfers of the form
        [(stop1_uid, stop2_uid, time), ...]
@@ -68,26 +106,14 @@ def compare_transfers(transfers0, transfers1):
                       len(transfers0), len(transfers1))
         return False
 
-    transfers0 = [tuple([t[0], t[1], t[2]])
-                      if t[0] < t[1] else
-                  tuple([t[1], t[0], t[2]])
-                      for t in transfers0]
-    transfers1 = [tuple([t[0], t[1], t[2]])
-                      if t[0] < t[1] else
-                  tuple([t[1], t[0], t[2]])
-                      for t in transfers1]
-
-    transfers0.sort()
-    transfers1.sort()
-
-    diff_cnt = 0
-    for tr0, tr1 in zip(transfers0, transfers1):
-        if tr0 != tr1:
-            if diff_cnt == 0:
-                logging.debug("First pair of different transfers: %s, %s",
-                              tr0, tr1)
-            diff_cnt += 1
-    if diff_cnt:
+    transfers0 = sorted(map(normalize_transfer, transfers0))
+    transfers1 = sorted(map(normalize_transfer, transfers1))
+
+    if transfers0 != transfers1:
+        diff_cnt = sum(map(operator.ne, transfers0, transfers1))
+        tr0, tr1 = next((tr0, tr1) for tr0, tr1 in zip(transfers0, transfers1)
+                        if tr0 != tr1)
+        logging.debug("First pair of different transfers: %s, %s", tr0, tr1)
         logging.debug("Different transfers number = %d", diff_cnt)
         return False
 
@@ -100,31 +126,31 @@ def compare_networks(network0, network1):
                       network0['network'])
         return False
 
-    route_ids0 = sorted(x['route_id'] for x in network0['routes'])
-    route_ids1 = sorted(x['route_id'] for x in network1['routes'])
+    routes0 = sorted(network0['routes'], key=_ROUTE_ID)
+    routes1 = sorted(network1['routes'], key=_ROUTE_ID)
+
+    route_ids0 = [x['route_id'] for x in routes0]
+    route_ids1 = [x['route_id'] for x in routes1]
 
     if route_ids0 != route_ids1:
         logging.debug("Different route_ids: %s != %s",
                       route_ids0, route_ids1)
         return False
 
-    routes0 = sorted(network0['routes'], key=lambda x: x['route_id'])
-    routes1 = sorted(network1['routes'], key=lambda x: x['route_id'])
-
-    # Keys to compare routes. 'name' key is omitted since RouteMaster
-    # can get its name from one of its Routes unpredictably.
-    route_keys = ('type', 'ref', 'colour', 'route_id')
-
     for route0, route1 in zip(routes0, routes1):
-        route0_props = tuple(route0[k] for k in route_keys)
-        route1_props = tuple(route1[k] for k in route_keys)
+        route0_props = _ROUTE_PROPS(route0)
+        route1_props = _ROUTE_PROPS(route1)
         if route0_props != route1_props:
             logging.debug("Route props of '%s' are different: %s, %s",
                           route0['route_id'], route0_props, route1_props)
             return False
 
-        itineraries0 = sorted(route0['itineraries'], key=itinerary_comparator)
-        itineraries1 = sorted(route1['itineraries'], key=itinerary_comparator)
+        itineraries0 = route0['itineraries']
+        itineraries1 = route1['itineraries']
+        if itineraries0 == itineraries1:
+            continue
+        itineraries0 = sorted(itineraries0, key=itinerary_comparator)
+        itineraries1 = sorted(itineraries1, key=itinerary_comparator)
 
         for itin0, itin1 in zip(itineraries0, itineraries1):
             if itin0['interval'] != itin1['interval']:
@@ -10,14 +10,63 @@
    affect the process_subways.py output really doesn't change it.
 """
 
-import sys
-import json
+import argparse
+import filecmp
 import logging
-from common import compare_stops, compare_transfers, compare_networks
+import multiprocessing
+import operator
+from concurrent.futures import ProcessPoolExecutor
+from common import (
+    compare_networks,
+    compare_stops,
+    compare_transfers,
+    load_json,
+)
 
 
-def compare_jsons(cache0, cache1):
-    """Compares two city caches"""
+# City caches being compared, set in each worker process
+_caches = None
+
+
+def _init_worker(cache0, cache1, log_level):
+    global _caches
+    _caches = (cache0, cache1)
+    # Spawned workers do not run the __main__ block that sets up logging
+    logging.basicConfig(level=log_level)
+
+
+def _compare_city_by_name(name):
+    return compare_cities(_caches[0][name], _caches[1][name])
+
+
+def compare_cities(city0, city1):
+    """Compares cached data of one city"""
+    if not compare_networks(city0['network'], city1['network']):
+        return False
+
+    stop_items0 = sorted(city0['stops'].items(), key=operator.itemgetter(0))
+    stop_items1 = sorted(city1['stops'].items(), key=operator.itemgetter(0))
+    stop_ids0 = [k for k, v in stop_items0]
+    stop_ids1 = [k for k, v in stop_items1]
+    if stop_ids0 != stop_ids1:
+        logging.debug("Different stop_ids")
+        return False
+    stops0 = [v for k, v in stop_items0]
+    stops1 = [v for k, v in stop_items1]
+    for stop0, stop1 in zip(stops0, stops1):
+        if not compare_stops(stop0, stop1):
+            return False
+
+    if not compare_transfers(city0['transfers'], city1['transfers']):
+        return False
+
+    return True
+
+
+def compare_jsons(cache0, cache1, processes=1):
+    """Compares two city caches. Cities are independent, so with
+       processes > 1 they are compared in a pool of worker processes.
+    """
 
     city_names0 = sorted(cache0.keys())
     city_names1 = sorted(cache1.keys())
@@ -25,41 +74,45 @@ def compare_jsons(cache0, cache1):
         logging.debug("Different list of city names!")
         return False
 
-    for name in city_names0:
-        city0 = cache0[name]
-        city1 = cache1[name]
-        if not compare_networks(city0['network'], city1['network']):
-            return False
-
-        stop_ids0 = sorted(city0['stops'].keys())
-        stop_ids1 = sorted(city1['stops'].keys())
-        if stop_ids0 != stop_ids1:
-            logging.debug("Different stop_ids")
-            return False
-        stops0 = [v for k, v in sorted(city0['stops'].items())]
-        stops1 = [v for k, v in sorted(city1['stops'].items())]
-        for stop0, stop1 in zip(stops0, stops1):
-            if not compare_stops(stop0, stop1):
+    if processes <= 1 or len(city_names0) <= 1:
+        return all(compare_cities(cache0[name], cache1[name])
+                   for name in city_names0)
+
+    # Forked workers inherit the caches instead of unpickling a copy each
+    if 'fork' in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context('fork')
+    else:
+        mp_context = multiprocessing.get_context()
+    with ProcessPoolExecutor(processes, mp_context=mp_context,
+                             initializer=_init_worker,
+                             initargs=(cache0, cache1,
+                                       logging.getLogger().level)) as executor:
+        for equal in executor.map(_compare_city_by_name, city_names0):
+            if not equal:
+                executor.shutdown(cancel_futures=True)
                 return False
 
-        if not compare_transfers(city0['transfers'], city1['transfers']):
-            return False
-
     return True
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 3:
-        print("Usage: {} <cache1.json> <cache2.json>".format(sys.argv[0]))
-        sys.exit()
+    parser = argparse.ArgumentParser(description='Compare two city caches')
+    parser.add_argument('cache0', help='First city cache json')
+    parser.add_argument('cache1', help='Second city cache json')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to compare cities in parallel')
+    options = parser.parse_args()
 
     logging.basicConfig(level=logging.DEBUG)
 
-    path0, path1 = sys.argv[1:3]
-
-    j0 = json.load(open(path0, encoding='utf-8'))
-    j1 = json.load(open(path1, encoding='utf-8'))
+    path0, path1 = options.cache0, options.cache1
 
-    equal = compare_jsons(j0, j1)
+    # Byte-identical files need no parsing
+    if filecmp.cmp(path0, path1, shallow=False):
+        equal = True
+    else:
+        j0 = load_json(path0)
+        j1 = load_json(path1)
+        equal = compare_jsons(j0, j1, options.processes)
 
     print("The city caches are {}equal".format("" if equal else "NOT "))
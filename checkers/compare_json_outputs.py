@@ -10,33 +10,39 @@
    affect the process_subways.py output really doesn't change it.
 """
 
+import filecmp
 import sys
-import json
 import logging
-from common import compare_stops, compare_transfers, compare_networks
+import operator
+from common import (
+    compare_networks,
+    compare_stops,
+    compare_transfers,
+    load_json,
+)
 
 
 def compare_jsons(result0, result1):
     """Compares two objects which are results of subway generation"""
 
-    network_names0 = sorted([x['network'] for x in result0['networks']])
-    network_names1 = sorted([x['network'] for x in result1['networks']])
+    networks0 = sorted(result0['networks'], key=operator.itemgetter('network'))
+    networks1 = sorted(result1['networks'], key=operator.itemgetter('network'))
+    network_names0 = [x['network'] for x in networks0]
+    network_names1 = [x['network'] for x in networks1]
     if network_names0 != network_names1:
         logging.debug("Different list of network names!")
         return False
-    networks0 = sorted(result0['networks'], key=lambda x: x['network'])
-    networks1 = sorted(result1['networks'], key=lambda x: x['network'])
     for network0, network1 in zip(networks0, networks1):
         if not compare_networks(network0, network1):
             return False
 
-    stop_ids0 = sorted(x['id'] for x in result0['stops'])
-    stop_ids1 = sorted(x['id'] for x in result1['stops'])
+    stops0 = sorted(result0['stops'], key=operator.itemgetter('id'))
+    stops1 = sorted(result1['stops'], key=operator.itemgetter('id'))
+    stop_ids0 = [x['id'] for x in stops0]
+    stop_ids1 = [x['id'] for x in stops1]
     if stop_ids0 != stop_ids1:
         logging.debug("Different stop_ids")
         return False
-    stops0 = sorted(result0['stops'], key=lambda x: x['id'])
-    stops1 = sorted(result1['stops'], key=lambda x: x['id'])
     for stop0, stop1 in zip(stops0, stops1):
         if not compare_stops(stop0, stop1):
             return False
@@ -56,9 +62,12 @@ if __name__ == "__main__":
 
     path0, path1 = sys.argv[1:3]
 
-    j0 = json.load(open(path0, encoding='utf-8'))
-    j1 = json.load(open(path1, encoding='utf-8'))
-
-    equal = compare_jsons(j0, j1)
+    # Byte-identical files need no parsing
+    if filecmp.cmp(path0, path1, shallow=False):
+        equal = True
+    else:
+        j0 = load_json(path0)
+        j1 = load_json(path1)
+        equal = compare_jsons(j0, j1)
 
     print("The results are {}equal".format("" if equal else "NOT "))
@@ -1,16 +1,26 @@
 #!/usr/bin/env python3
 import argparse
+import gzip
+import hashlib
 import json
 import logging
+import math
+import multiprocessing
 import os
 import re
 import sys
+import tempfile
 import time
+import urllib.error
 import urllib.parse
 import urllib.request
+from collections import defaultdict
+from functools import lru_cache
 from processors import processor
 from subway_io import (
+    dump_json,
     dump_yaml,
+    load_json,
     load_xml,
     make_geojson,
     read_recovery_data,
@@ -19,52 +29,213 @@ from subway_io import (
 from subway_structure import (
     CriticalValidationError,
     download_cities,
+    el_center,
     find_transfers,
     get_unused_entrances_geojson,
+    is_stop_area_group,
     MODES_OVERGROUND,
     MODES_RAPID,
+    used_entrances,
 )
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-def overpass_request(overground, overpass_api, bboxes=None):
+OVERPASS_RETRIES = 4
+OVERPASS_CACHE_TTL = 7 * 24 * 3600  # Seconds to reuse a cached response for
+
+
+@lru_cache(maxsize=None)
+def bbox_query_template(overground):
+    """Returns the part of an Overpass query for one bbox,
+       with a {bbox} placeholder for the bbox filter.
+    """
+    modes = MODES_OVERGROUND if overground else MODES_RAPID
+    query = '('
+    # Modes are a set: sort them to get the same query in every run
+    for mode in sorted(modes):
+        query += 'rel[route="{}"]{{bbox}};'.format(mode)
+    query += ');'
+    query += 'rel(br)[type=route_master];'
+    if not overground:
+        query += 'node[railway=subway_entrance]{bbox};'
+    query += 'rel[public_transport=stop_area]{bbox};'
+    query += 'rel(br)[type=public_transport][public_transport=stop_area_group];'
+    return query
+
+
+def overpass_request(overground, overpass_api, bboxes=None, cache_dir=None):
     query = '[out:json][timeout:1000];('
     if bboxes is None:
         bboxes = [None]
-    modes = MODES_OVERGROUND if overground else MODES_RAPID
+    template = bbox_query_template(overground)
     for bbox in bboxes:
         bbox_part = '' if not bbox else '({})'.format(','.join(str(coord) for coord in bbox))
-        query += '('
-        for mode in modes:
-            query += 'rel[route="{}"]{};'.format(mode, bbox_part)
-        query += ');'
-        query += 'rel(br)[type=route_master];'
-        if not overground:
-            query += 'node[railway=subway_entrance]{};'.format(bbox_part)
-        query += 'rel[public_transport=stop_area]{};'.format(bbox_part)
-        query += 'rel(br)[type=public_transport][public_transport=stop_area_group];'
+        query += template.format(bbox=bbox_part)
     query += ');(._;>>;);out body center qt;'
     logging.debug('Query: %s', query)
     url = '{}?data={}'.format(overpass_api, urllib.parse.quote(query))
-    response = urllib.request.urlopen(url, timeout=1000)
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir, hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+        if (os.path.exists(cache_path) and
+                time.time() - os.path.getmtime(cache_path) < OVERPASS_CACHE_TTL):
+            logging.info('Reading Overpass API response from %s', cache_path)
+            return read_source(cache_path)
+    for attempt in range(OVERPASS_RETRIES):
+        try:
+            # Overpass API compresses responses if asked to
+            request = urllib.request.Request(url, headers={'Accept-Encoding': 'gzip'})
+            response = urllib.request.urlopen(request, timeout=1000)
+            break
+        except urllib.error.HTTPError as e:
+            # Too many requests or the server is overloaded: wait and retry
+            if e.code not in (429, 504) or attempt == OVERPASS_RETRIES - 1:
+                raise
+            # Retry-After can also be a date, then just back off
+            retry_after = e.headers.get('Retry-After', '') if e.headers else ''
+            delay = int(retry_after) if retry_after.isdigit() else 5 * 2 ** attempt
+            logging.warning('Overpass API returned HTTP %s, retrying in %s seconds',
+                            e.code, delay)
+            time.sleep(delay)
     if response.getcode() != 200:
         raise Exception('Failed to query Overpass API: HTTP {}'.format(response.getcode()))
-    return json.load(response)['elements']
+    if response.headers.get('Content-Encoding') == 'gzip':
+        # Decompressed while being read, so parsing still streams
+        response = gzip.GzipFile(fileobj=response)
+    if ijson is not None:
+        # Parse elements while the response is being read,
+        # without keeping the whole body in memory
+        elements = list(ijson.items(response, 'elements.item', use_float=True))
+    else:
+        elements = json.load(response)['elements']
+    if cache_dir:
+        # Write to a temporary file first, so that an interrupted run
+        # does not leave a truncated response in the cache
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with open(fd, 'w', encoding='utf-8') as f:
+                dump_json(elements, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return elements
 
 
-def multi_overpass(overground, overpass_api, bboxes):
+def remove_nested_bboxes(bboxes):
+    """Returns bboxes without duplicates and bboxes lying inside other ones,
+       since querying those adds nothing. Keeps the order of the rest.
+    """
+    def inside(b1, b2):
+        return (b1[0] >= b2[0] and b1[1] >= b2[1] and
+                b1[2] <= b2[2] and b1[3] <= b2[3])
+
+    if not all(bboxes):
+        # A city without a bbox makes the query cover the whole world
+        return [None]
+    unique = list(dict.fromkeys(tuple(bbox) for bbox in bboxes))
+    return [bbox for bbox in unique
+            if not any(other is not bbox and inside(bbox, other) for other in unique)]
+
+
+def multi_overpass(overground, overpass_api, bboxes, cache_dir=None):
     if not bboxes:
-        return overpass_request(overground, overpass_api, None)
+        return overpass_request(overground, overpass_api, None, cache_dir)
+    bboxes = remove_nested_bboxes(bboxes)
     SLICE_SIZE = 10
     result = []
-    for i in range(0, len(bboxes) + SLICE_SIZE - 1, SLICE_SIZE):
-        if i > 0:
-            time.sleep(5)
-        result.extend(overpass_request(overground, overpass_api, bboxes[i:i+SLICE_SIZE]))
+    for i in range(0, len(bboxes), SLICE_SIZE):
+        result.extend(overpass_request(overground, overpass_api,
+                                       bboxes[i:i+SLICE_SIZE], cache_dir))
     return result
 
 
+SLUG_RE = re.compile(r'[^a-z0-9_-]+')
+
+
+@lru_cache(maxsize=None)
 def slugify(name):
-    return re.sub(r'[^a-z0-9_-]+', '', name.lower().replace(' ', '_'))
+    return SLUG_RE.sub('', name.lower().replace(' ', '_'))
+
+
+def sort_elements_by_city(elements, cities):
+    """Adds each element to all cities which contain it. Cities are indexed
+       by 1x1 degree cells of their bboxes, so that an element is checked only
+       against cities around it.
+       Returns stop_area_group relations met on the way, so that
+       find_transfers does not need to scan all elements again.
+    """
+    grid = defaultdict(list)  # (lat, lon) of a cell's corner => list of cities
+    for c in cities:
+        if not c.bbox:
+            continue
+        for lat in range(math.floor(c.bbox[0]), math.floor(c.bbox[2]) + 1):
+            for lon in range(math.floor(c.bbox[1]), math.floor(c.bbox[3]) + 1):
+                grid[(lat, lon)].append(c)
+
+    stop_area_groups = []
+    for el in elements:
+        if is_stop_area_group(el):
+            stop_area_groups.append(el)
+        center = el_center(el)
+        if center:
+            cell = (math.floor(center[1]), math.floor(center[0]))
+            for c in grid.get(cell, ()):
+                if c.contains(el):
+                    c.add(el)
+    return stop_area_groups
+
+
+def validate_city(c):
+    try:
+        c.extract_routes()
+    except CriticalValidationError as e:
+        logging.error("Critical validation error while processing %s: %s", c.name, str(e))
+        c.error(str(e))
+    except AssertionError as e:
+        logging.error("Validation logic error while processing %s: %s", c.name, str(e))
+        c.error("Validation logic error: {}".format(str(e)))
+    else:
+        c.validate()
+
+
+def validate_city_in_worker(c):
+    """Validates a city in a worker process. Subway entrances marked as used
+       there must be passed back along with the city.
+    """
+    validate_city(c)
+    return c, used_entrances
+
+
+def read_source(path):
+    """Reads OSM elements from a backup made with -i option
+       or from a cached Overpass API response.
+       The file may be gzipped, which is detected by its first bytes.
+    """
+    with open(path, 'rb') as f:
+        gzipped = f.read(2) == b'\x1f\x8b'
+    with (gzip.open(path, 'rb') if gzipped else open(path, 'rb')) as f:
+        # The file is either a list of elements or an Overpass
+        # response with an 'elements' list
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        return load_json(f, 'elements.item' if first == b'{' else 'item')
+
+
+def write_source(path, elements):
+    """Writes OSM elements backup, gzipped if the file name ends with .gz"""
+    if path.endswith('.gz'):
+        f = gzip.open(path, 'wt', encoding='utf-8', compresslevel=3)
+    else:
+        f = open(path, 'w', encoding='utf-8')
+    with f:
+        dump_json(elements, f)
 
 
 def calculate_centers(elements):
@@ -72,36 +243,43 @@ def calculate_centers(elements):
        except for empty ways or relations.
        Relies on nodes-ways-relations order in the elements list.
     """
-    nodes = {}      # id(int) => (lat, lon)
-    ways = {}       # id(int) => (lat, lon)
-    relations = {}  # id(int) => (lat, lon)
+    # Containers reference existing dicts with 'lat' and 'lon' keys:
+    # node elements and 'center' of ways and relations
+    nodes = {}      # id(int) => node element
+    ways = {}       # id(int) => center
+    relations = {}  # id(int) => center
     empty_relations = set()  # ids(int) of relations without members
                              # or containing only empty relations
+    containers = {'node': nodes, 'way': ways, 'relation': relations}
 
     def calculate_way_center(el):
         # If element has been queried via overpass-api with 'out center;'
         # clause then ways already have 'center' attribute
         if 'center' in el:
-            ways[el['id']] = (el['center']['lat'], el['center']['lon'])
+            ways[el['id']] = el['center']
             return
-        center = [0, 0]
+        lat = lon = 0
         count = 0
         for nd in el['nodes']:
-            if nd in nodes:
-                center[0] += nodes[nd][0]
-                center[1] += nodes[nd][1]
+            coords = nodes.get(nd)
+            if coords:
+                lat += coords['lat']
+                lon += coords['lon']
                 count += 1
         if count > 0:
-            el['center'] = {'lat': center[0] / count, 'lon': center[1] / count}
-            ways[el['id']] = (el['center']['lat'], el['center']['lon'])
+            el['center'] = {'lat': lat / count, 'lon': lon / count}
+            ways[el['id']] = el['center']
 
     def calculate_relation_center(el):
+        """Returns id of a child relation which center is not known yet,
+           or None if the relation has got its center or turned out empty.
+        """
         # If element has been queried via overpass-api with 'out center;'
         # clause then some relations already have 'center' attribute
         if 'center' in el:
-            relations[el['id']] = (el['center']['lat'], el['center']['lon'])
-            return True
-        center = [0, 0]
+            relations[el['id']] = el['center']
+            return None
+        lat = lon = 0
         count = 0
         for m in el.get('members', []):
             if m['type'] == 'relation' and m['ref'] not in relations:
@@ -110,44 +288,49 @@ def calculate_centers(elements):
                     continue
                 else:
                     # Center of child relation is not known yet
-                    return False
-            member_container = (nodes if m['type'] == 'node' else
-                                ways if m['type'] == 'way' else
-                                relations)
-            if m['ref'] in member_container:
-                center[0] += member_container[m['ref']][0]
-                center[1] += member_container[m['ref']][1]
+                    return m['ref']
+            coords = containers[m['type']].get(m['ref'])
+            if coords:
+                lat += coords['lat']
+                lon += coords['lon']
                 count += 1
         if count == 0:
             empty_relations.add(el['id'])
         else:
-            el['center'] = {'lat': center[0] / count, 'lon': center[1] / count}
-            relations[el['id']] = (el['center']['lat'], el['center']['lon'])
-        return True
+            el['center'] = {'lat': lat / count, 'lon': lon / count}
+            relations[el['id']] = el['center']
+        return None
+
+    # Relations waiting for a child relation center, in the order they came
+    relations_without_center = {}  # id(int) => relation element
+    waiting = defaultdict(list)  # id(int) of child => list of parent elements
 
-    relations_without_center = []
+    def process_relation(el):
+        # When a relation gets its center, retry only the relations
+        # that have been waiting for it
+        queue = [el]
+        while queue:
+            el = queue.pop()
+            child_id = calculate_relation_center(el)
+            if child_id is not None:
+                waiting[child_id].append(el)
+                relations_without_center.setdefault(el['id'], el)
+            else:
+                relations_without_center.pop(el['id'], None)
+                queue.extend(waiting.pop(el['id'], ()))
 
     for el in elements:
         if el['type'] == 'node':
-            nodes[el['id']] = (el['lat'], el['lon'])
+            nodes[el['id']] = el
         elif el['type'] == 'way':
             if 'nodes' in el:
                 calculate_way_center(el)
         elif el['type'] == 'relation':
-            if not calculate_relation_center(el):
-                relations_without_center.append(el)
-
-    # Calculate centers for relations that have no one yet
-    while relations_without_center:
-        new_relations_without_center = []
-        for rel in relations_without_center:
-            if not calculate_relation_center(rel):
-                new_relations_without_center.append(rel)
-        if len(new_relations_without_center) == len(relations_without_center):
-            break
-        relations_without_center = new_relations_without_center
+            process_relation(el)
 
+    # What is left references missing relations or forms a cycle
     if relations_without_center:
+        relations_without_center = list(relations_without_center.values())
         logging.error("Cannot calculate center for the relations (%d in total): %s%s",
                       len(relations_without_center),
                       ', '.join(str(rel['id']) for rel in relations_without_center[:20]),
@@ -162,7 +345,8 @@ def calculate_centers(elements):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
-        '-i', '--source', help='File to write backup of OSM data, or to read data from')
+        '-i', '--source',
+        help='File to write backup of OSM data, or to read data from (gzipped if named *.gz)')
     parser.add_argument('-x', '--xml', help='OSM extract with routes, to read data from')
     parser.add_argument('--overpass-api',
                         default='http://overpass-api.de/api/interpreter',
@@ -170,7 +354,12 @@ if __name__ == '__main__':
     parser.add_argument(
         '-b', '--bbox', action='store_true',
         help='Use city boundaries to query Overpass API instead of querying the world')
+    parser.add_argument(
+        '--overpass-cache',
+        help='Directory to keep Overpass API responses in, they are reused for a week')
     parser.add_argument('-q', '--quiet', action='store_true', help='Show only warnings and errors')
+    parser.add_argument('-p', '--processes', type=int, default=1,
+                        help='Number of processes to validate cities in parallel')
     parser.add_argument('-c', '--city', help='Validate only a single city or a country')
     parser.add_argument('-t', '--overground', action='store_true',
                         help='Process overground transport instead of subways')
@@ -215,18 +404,14 @@ if __name__ == '__main__':
     # Reading cached json, loading XML or querying Overpass API
     if options.source and os.path.exists(options.source):
         logging.info('Reading %s', options.source)
-        with open(options.source, 'r') as f:
-            osm = json.load(f)
-            if 'elements' in osm:
-                osm = osm['elements']
-            calculate_centers(osm)
+        osm = read_source(options.source)
+        calculate_centers(osm)
     elif options.xml:
         logging.info('Reading %s', options.xml)
         osm = load_xml(options.xml)
         calculate_centers(osm)
         if options.source:
-            with open(options.source, 'w', encoding='utf-8') as f:
-                json.dump(osm, f)
+            write_source(options.source, osm)
     else:
         if len(cities) > 10:
             logging.error('Would not download that many cities from Overpass API, '
@@ -237,42 +422,37 @@ if __name__ == '__main__':
         else:
             bboxes = None
         logging.info('Downloading data from Overpass API')
-        osm = multi_overpass(options.overground, options.overpass_api, bboxes)
+        osm = multi_overpass(options.overground, options.overpass_api, bboxes,
+                             options.overpass_cache)
         calculate_centers(osm)
         if options.source:
-            with open(options.source, 'w', encoding='utf-8') as f:
-                json.dump(osm, f)
+            write_source(options.source, osm)
     logging.info('Downloaded %s elements, sorting by city', len(osm))
 
     # Sorting elements by city and prepare a dict
-    for el in osm:
-        for c in cities:
-            if c.contains(el):
-                c.add(el)
+    stop_area_groups = sort_elements_by_city(osm, cities)
 
     logging.info('Building routes for each city')
-    good_cities = []
-    for c in cities:
-        try:
-            c.extract_routes()
-        except CriticalValidationError as e:
-            logging.error("Critical validation error while processing %s: %s", c.name, str(e))
-            c.error(str(e))
-        except AssertionError as e:
-            logging.error("Validation logic error while processing %s: %s", c.name, str(e))
-            c.error("Validation logic error: {}".format(str(e)))
-        else:
-            c.validate()
-            if c.is_good():
-                good_cities.append(c)
+    if options.processes > 1 and len(cities) > 1:
+        # Cities are independent, validate them in parallel
+        with multiprocessing.Pool(options.processes) as pool:
+            results = pool.map(validate_city_in_worker, cities)
+        cities = []
+        for c, worker_used_entrances in results:
+            cities.append(c)
+            used_entrances.update(worker_used_entrances)
+    else:
+        for c in cities:
+            validate_city(c)
+    good_cities = [c for c in cities if c.is_good()]
 
     logging.info('Finding transfer stations')
-    transfers = find_transfers(osm, cities)
+    transfers = find_transfers(stop_area_groups, cities)
 
-    good_city_names = set(c.name for c in good_cities)
+    good_city_names = {c.name for c in good_cities}
     logging.info('%s good cities: %s', len(good_city_names),
                  ', '.join(sorted(good_city_names)))
-    bad_city_names = set(c.name for c in cities) - good_city_names
+    bad_city_names = {c.name for c in cities} - good_city_names
     logging.info('%s bad cities: %s', len(bad_city_names),
                  ', '.join(sorted(bad_city_names)))
 
@@ -280,7 +460,7 @@ if __name__ == '__main__':
         write_recovery_data(options.recovery_path, recovery_data, cities)
 
     if options.entrances:
-        json.dump(get_unused_entrances_geojson(osm), options.entrances)
+        dump_json(get_unused_entrances_geojson(osm), options.entrances)
 
     if options.dump:
         if os.path.isdir(options.dump):
@@ -299,10 +479,10 @@ if __name__ == '__main__':
             for c in cities:
                 with open(os.path.join(options.geojson, slugify(c.name) + '.geojson'),
                           'w', encoding='utf-8') as f:
-                    json.dump(make_geojson(c, not options.crude), f)
+                    dump_json(make_geojson(c, not options.crude), f)
         elif len(cities) == 1:
             with open(options.geojson, 'w', encoding='utf-8') as f:
-                json.dump(make_geojson(cities[0], not options.crude), f)
+                dump_json(make_geojson(cities[0], not options.crude), f)
         else:
             logging.error('Cannot make a geojson of %s cities at once', len(cities))
 
@@ -312,8 +492,8 @@ if __name__ == '__main__':
             v = c.get_validation_result()
             v['slug'] = slugify(c.name)
             res.append(v)
-        json.dump(res, options.log, indent=2, ensure_ascii=False)
+        dump_json(res, options.log, indent=2)
 
     if options.output:
-        json.dump(processor.process(cities, transfers, options.cache),
-                  options.output, indent=1, ensure_ascii=False)
+        dump_json(processor.process(cities, transfers, options.cache),
+                  options.output, indent=1)
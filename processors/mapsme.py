@@ -2,10 +2,13 @@ import json
 import os
 import logging
 from collections import defaultdict
+from functools import lru_cache
+from itertools import combinations
 from subway_structure import (
     distance, el_center, Station,
     DISPLACEMENT_TOLERANCE
 )
+from subway_io import dump_json, load_json
 
 
 OSM_TYPES = {'n': (0, 'node'), 'w': (2, 'way'), 'r': (3, 'relation')}
@@ -18,7 +21,9 @@ SPEED_ON_LINE = 40 * KMPH_TO_MPS  # m/s
 DEFAULT_INTERVAL = 2.5  # minutes
 
 
+@lru_cache(maxsize=None)
 def uid(elid, typ=None):
+    # The same stop areas recur in itineraries, stops and transfers
     t = elid[0]
     osm_id = int(elid[1:])
     if not typ:
@@ -63,9 +68,9 @@ class MapsmeCache:
         self.cache = {}
         if os.path.exists(cache_path):
             try:
-                with open(cache_path, 'r', encoding='utf-8') as f:
-                    self.cache = json.load(f)
-            except json.decoder.JSONDecodeError:
+                with open(cache_path, 'rb') as f:
+                    self.cache = load_json(f)
+            except json.decoder.JSONDecodeError:  # orjson's error is a subclass
                 logging.warning("City cache '%s' is not a valid json file. "
                                 "Building cache from scratch.", cache_path)
         self.recovered_city_names = set()
@@ -153,7 +158,7 @@ class MapsmeCache:
     def save(self):
         try:
             with open(self.cache_path, 'w', encoding='utf-8') as f:
-                json.dump(self.cache, f, ensure_ascii=False)
+                dump_json(self.cache, f)
         except Exception as e:
             logging.warning("Failed to save cache: %s", str(e))
 
@@ -297,21 +302,16 @@ def process(cities, transfers, cache_path):
 
     pairwise_transfers = {}  # (stoparea1_uid, stoparea2_uid) -> time;  uid1 < uid2
     for t_set in transfers:
-        t = list(t_set)
-        for t_first in range(len(t) - 1):
-            for t_second in range(t_first + 1, len(t)):
-                stoparea1 = t[t_first]
-                stoparea2 = t[t_second]
-                if stoparea1.id in stops and stoparea2.id in stops:
-                    uid1 = uid(stoparea1.id)
-                    uid2 = uid(stoparea2.id)
-                    uid1, uid2 = sorted([uid1, uid2])
-                    transfer_time = (TRANSFER_PENALTY
-                                     + round(distance(stoparea1.center,
-                                                      stoparea2.center)
-                                                      / SPEED_ON_TRANSFER))
-                    pairwise_transfers[(uid1, uid2)] = transfer_time
-                    cache.add_transfer(uid1, uid2, transfer_time)
+        # Filter and identify stop areas once, not for every pair
+        t = [(uid(stoparea.id), stoparea.center)
+             for stoparea in t_set if stoparea.id in stops]
+        for (uid1, center1), (uid2, center2) in combinations(t, 2):
+            uid1, uid2 = sorted([uid1, uid2])
+            transfer_time = (TRANSFER_PENALTY
+                             + round(distance(center1, center2)
+                                     / SPEED_ON_TRANSFER))
+            pairwise_transfers[(uid1, uid2)] = transfer_time
+            cache.add_transfer(uid1, uid2, transfer_time)
 
     cache.provide_transfers(pairwise_transfers)
     cache.save()
@@ -1,31 +1,84 @@
+import codecs
 import json
 import logging
 from collections import OrderedDict
+from operator import itemgetter
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_json(data, f, indent=None):
+    """Writes json to a text file, with orjson if it is installed.
+       The output is not ASCII-escaped. When indent is set, it is
+       pretty-printed; orjson always indents with two spaces.
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        encoded = orjson.dumps(data, option=option)
+        if (hasattr(f, 'buffer') and
+                codecs.lookup(f.encoding or 'ascii').name == 'utf-8'):
+            # Write bytes under the text layer instead of decoding them
+            f.flush()
+            f.buffer.write(encoded)
+        else:
+            f.write(encoded.decode('utf-8'))
+    else:
+        json.dump(data, f, indent=indent, ensure_ascii=False)
+
+
+def load_json(f, items=None):
+    """Reads json from a binary file, with orjson if it is installed.
+       With items, an ijson prefix like 'elements.item', returns the list
+       found there; without orjson, it is streamed with ijson if possible.
+    """
+    if items is not None and orjson is None and ijson is not None:
+        return list(ijson.items(f, items, use_float=True))
+    data = orjson.loads(f.read()) if orjson is not None else json.load(f)
+    if items is not None:
+        for key in items.split('.')[:-1]:
+            data = data[key]
+    return data
 
 
 def load_xml(f):
     try:
         from lxml import etree
+        # Let the parser skip tag/nd/member events and allow big extracts
+        parse_options = {'tag': ('node', 'way', 'relation'), 'huge_tree': True}
     except ImportError:
         import xml.etree.ElementTree as etree
+        parse_options = {}
 
     elements = []
 
-    for event, element in etree.iterparse(f):
+    for event, element in etree.iterparse(f, events=('end',), **parse_options):
         if element.tag in ('node', 'way', 'relation'):
             el = {'type': element.tag, 'id': int(element.get('id'))}
             if element.tag == 'node':
                 for n in ('lat', 'lon'):
                     el[n] = float(element.get(n))
-            tags = {}
-            nd = []
-            members = []
+            # Most nodes have no children, so containers are created on demand
+            tags = nd = members = None
             for sub in element:
                 if sub.tag == 'tag':
+                    if tags is None:
+                        tags = {}
                     tags[sub.get('k')] = sub.get('v')
                 elif sub.tag == 'nd':
+                    if nd is None:
+                        nd = []
                     nd.append(int(sub.get('ref')))
                 elif sub.tag == 'member':
+                    if members is None:
+                        members = []
                     members.append({'type': sub.get('type'),
                                     'ref': int(sub.get('ref')),
                                     'role': sub.get('role', '')})
@@ -37,6 +90,11 @@ def load_xml(f):
                 el['members'] = members
             elements.append(el)
             element.clear()
+            # Cleared elements are still referenced by the root.
+            # With lxml we can drop them, so the tree does not grow.
+            if hasattr(element, 'getprevious'):
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
 
     return elements
 
@@ -57,25 +115,45 @@ def _get_yaml_compatible_string(scalar):
 
 
 def dump_yaml(city, f):
-    def write_yaml(data, f, indent=''):
-        if isinstance(data, (set, list)):
-            f.write('\n')
-            for i in data:
-                f.write(indent)
-                f.write('- ')
-                write_yaml(i, f, indent + '  ')
-        elif isinstance(data, dict):
-            f.write('\n')
-            for k, v in data.items():
-                if v is None:
-                    continue
-                f.write(indent + _get_yaml_compatible_string(k) + ': ')
-                write_yaml(v, f, indent + '  ')
-                if isinstance(v, (list, set, dict)):
-                    f.write('\n')
-        else:
-            f.write(_get_yaml_compatible_string(data))
-            f.write('\n')
+    def write_yaml(data, out):
+        """Appends YAML lines to the 'out' list, which is written at once.
+        Uses a stack of (data, indent) items instead of recursion; plain
+        strings on the stack are appended to the output as is."""
+        stack = [(data, '')]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                out.append(item)
+                continue
+            data, indent = item
+            if isinstance(data, (set, list)):
+                out.append('\n')
+                child_indent = indent + '  '
+                for i in reversed(list(data)):
+                    stack.append((i, child_indent))
+                    stack.append(indent + '- ')
+            elif isinstance(data, dict):
+                out.append('\n')
+                child_indent = indent + '  '
+                for k, v in reversed(list(data.items())):
+                    if v is None:
+                        continue
+                    if isinstance(v, (list, set, dict)):
+                        stack.append('\n')
+                    stack.append((v, child_indent))
+                    stack.append(indent + _get_yaml_compatible_string(k) + ': ')
+            else:
+                out.append(_get_yaml_compatible_string(data) + '\n')
+
+    # The same station appears in many variants, so build its label once
+    labels = {}
+
+    def station_label(station):
+        label = labels.get(station.id)
+        if label is None:
+            label = '{} ({})'.format(station.name, station.id)
+            labels[station.id] = label
+        return label
 
     INCLUDE_STOP_AREAS = False
     stops = set()
@@ -103,23 +181,26 @@ def dump_yaml(city, f):
                         v_stops.append('{} ({}) in {} ({})'.format(s.station.name, s.station.id,
                                                                    s.name, s.id))
             else:
-                v_stops = ['{} ({})'.format(
-                    s.stoparea.station.name,
-                    s.stoparea.station.id) for s in variant]
+                v_stops = [station_label(s.stoparea.station) for s in variant]
             rte['itineraries'][variant.id] = v_stops
             stops.update(v_stops)
         routes.append(rte)
     transfers = []
     for t in city.transfers:
-        v_stops = ['{} ({})'.format(s.name, s.id) for s in t]
-        transfers.append(sorted(v_stops))
+        v_stops = [station_label(s) for s in t]
+        v_stops.sort()
+        transfers.append(v_stops)
+    transfers.sort(key=itemgetter(0))
+    routes.sort(key=itemgetter('ref'))
 
     result = {
         'stations': sorted(stops),
-        'transfers': sorted(transfers, key=lambda t: t[0]),
-        'routes': sorted(routes, key=lambda r: r['ref']),
+        'transfers': transfers,
+        'routes': routes,
     }
-    write_yaml(result, f)
+    out = []
+    write_yaml(result, out)
+    f.write(''.join(out))
 
 
 def make_geojson(city, tracks=True):
@@ -131,12 +212,17 @@ def make_geojson(city, tracks=True):
     stops = set()
     for rmaster in city:
         for variant in rmaster:
+            coords = []
+            for st in variant:
+                coords.append(st.stop)
+                stopareas.add(st.stoparea)
+            stops.update(coords)
             if not tracks:
                 features.append({
                     'type': 'Feature',
                     'geometry': {
                         'type': 'LineString',
-                        'coordinates': [s.stop for s in variant],
+                        'coordinates': coords,
                     },
                     'properties': {
                         'ref': variant.ref,
@@ -157,10 +243,12 @@ def make_geojson(city, tracks=True):
                         'stroke': variant.colour
                     }
                 })
-            for st in variant:
-                stops.add(st.stop)
-                stopareas.add(st.stoparea)
 
+    # All stop points look the same, so they share one properties dict
+    stop_properties = {
+        'marker-size': 'small',
+        'marker-symbol': 'circle'
+    }
     for stop in stops:
         features.append({
             'type': 'Feature',
@@ -168,10 +256,7 @@ def make_geojson(city, tracks=True):
                 'type': 'Point',
                 'coordinates': stop,
             },
-            'properties': {
-                'marker-size': 'small',
-                'marker-symbol': 'circle'
-            }
+            'properties': stop_properties
         })
     for stoparea in stopareas:
         features.append({
@@ -54,6 +54,11 @@ def el_center(el):
     return None
 
 
+def is_stop_area_group(el):
+    return (el['type'] == 'relation' and 'members' in el and
+            el.get('tags', {}).get('public_transport') == 'stop_area_group')
+
+
 def distance(p1, p2):
     if p1 is None or p2 is None:
         raise Exception('One of arguments to distance({}, {}) is None'.format(p1, p2))
@@ -1451,11 +1456,7 @@ class City:
 
 def find_transfers(elements, cities):
     transfers = []
-    stop_area_groups = []
-    for el in elements:
-        if (el['type'] == 'relation' and 'members' in el and
-                el.get('tags', {}).get('public_transport') == 'stop_area_group'):
-            stop_area_groups.append(el)
+    stop_area_groups = [el for el in elements if is_stop_area_group(el)]
 
     # StopArea.id uniquely identifies a StopArea.
     # We must ensure StopArea uniqueness since one stop_area relation may result in